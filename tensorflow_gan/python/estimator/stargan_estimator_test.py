@@ -19,90 +19,152 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import shutil
-import tempfile
-
-from absl.testing import parameterized
 import numpy as np
-import six
 
 import tensorflow as tf
 import tensorflow_gan as tfgan
 
+from tensorflow.core.protobuf import rewriter_config_pb2  # pylint: disable=g-direct-tensorflow-import
+
 # Private functions to test.
 from tensorflow_gan.python.estimator.stargan_estimator import get_estimator_spec
 from tensorflow_gan.python.estimator.stargan_estimator import get_gan_model
 
+# Plain gradient descent keeps no per-variable state, so a single instance can
+# serve as both the generator and the discriminator optimizer in every test.
+_OPTIMIZER = tf.compat.v1.train.GradientDescentOptimizer(1.0)
+
+# Graph shared by the structural tests, which only inspect the tensors they
+# build. Each test class and method builds under its own variable scope.
+_GRAPH = None
+
+
+def setUpModule():  # pylint: disable=invalid-name
+  global _GRAPH  # pylint: disable=global-statement
+  _GRAPH = tf.Graph()
+
 
 def dummy_generator_fn(input_data, input_data_domain_label, mode):
   del input_data_domain_label, mode
 
+  # `stargan_model` calls this twice per graph; the reconstruction call runs
+  # under `reuse=True`, so it gets back the same variable without new ops.
   return tf.compat.v1.get_variable('dummy_g', initializer=0.5) * input_data
 
 
 def dummy_discriminator_fn(input_data, num_domains, mode):
   del mode
 
-  hidden = tf.compat.v1.layers.flatten(input_data)
+  num_features = input_data.shape[1:].num_elements()
+  hidden = tf.reshape(input_data, [-1, num_features])
+  kernel = tf.compat.v1.get_variable('debug/kernel',
+                                     [num_features, num_domains])
+  bias = tf.compat.v1.get_variable(
+      'debug/bias', [num_domains],
+      initializer=tf.compat.v1.zeros_initializer())
   output_src = tf.reduce_mean(input_tensor=hidden, axis=1)
-  output_cls = tf.compat.v1.layers.dense(hidden, num_domains, name='debug')
+  output_cls = tf.nn.bias_add(tf.linalg.matmul(hidden, kernel), bias)
 
   return output_src, output_cls
 
 
-class StarGetGANModelTest(tf.test.TestCase, parameterized.TestCase):
+def get_session_config():
+  """Returns a `ConfigProto` that skips Grappler passes tiny graphs don't need.
+
+  The test graphs are small and convolution-free, so the layout, arithmetic and
+  dependency optimizers only add graph-rewrite time to every session. XLA
+  auto-clustering is pinned off for the same reason: compiling the clusters
+  costs more than the handful of steps the tests run.
+  """
+  config = tf.compat.v1.ConfigProto()
+  config.graph_options.optimizer_options.global_jit_level = (
+      tf.compat.v1.OptimizerOptions.OFF)
+  rewrite_options = config.graph_options.rewrite_options
+  rewrite_options.layout_optimizer = rewriter_config_pb2.RewriterConfig.OFF
+  rewrite_options.arithmetic_optimization = (
+      rewriter_config_pb2.RewriterConfig.OFF)
+  rewrite_options.dependency_optimization = (
+      rewriter_config_pb2.RewriterConfig.OFF)
+  return config
+
+
+class StarGetGANModelTest(tf.test.TestCase):
   """Tests that `StarGetGANModel` produces the correct model."""
 
-  @parameterized.named_parameters(('train', tf.estimator.ModeKeys.TRAIN),
-                                  ('eval', tf.estimator.ModeKeys.EVAL),
-                                  ('predict', tf.estimator.ModeKeys.PREDICT))
-  def test_get_gan_model(self, mode):
-    with tf.Graph().as_default():
-      input_data = tf.ones([6, 4, 4, 3])
-      input_data_domain_label = tf.one_hot([0] * 6, 5)
-      gan_model = get_gan_model(
-          mode,
-          dummy_generator_fn,
-          dummy_discriminator_fn,
-          input_data,
-          input_data_domain_label,
-          add_summaries=False)
-
-    self.assertEqual(input_data, gan_model.input_data)
-    self.assertIsNotNone(gan_model.generated_data)
-    self.assertIsNotNone(gan_model.generated_data_domain_target)
-    self.assertLen(gan_model.generator_variables, 1)
-    self.assertIsNotNone(gan_model.generator_scope)
-    self.assertIsNotNone(gan_model.generator_fn)
-    if mode == tf.estimator.ModeKeys.PREDICT:
-      self.assertIsNone(gan_model.input_data_domain_label)
-      self.assertEqual(input_data_domain_label,
-                       gan_model.generated_data_domain_target)
-      self.assertIsNone(gan_model.reconstructed_data)
-      self.assertIsNone(gan_model.discriminator_input_data_source_predication)
-      self.assertIsNone(
-          gan_model.discriminator_generated_data_source_predication)
-      self.assertIsNone(gan_model.discriminator_input_data_domain_predication)
-      self.assertIsNone(
-          gan_model.discriminator_generated_data_domain_predication)
-      self.assertIsNone(gan_model.discriminator_variables)
-      self.assertIsNone(gan_model.discriminator_scope)
-      self.assertIsNone(gan_model.discriminator_fn)
-    else:
-      self.assertEqual(input_data_domain_label,
-                       gan_model.input_data_domain_label)
-      self.assertIsNotNone(gan_model.reconstructed_data.shape)
-      self.assertIsNotNone(
-          gan_model.discriminator_input_data_source_predication)
-      self.assertIsNotNone(
-          gan_model.discriminator_generated_data_source_predication)
-      self.assertIsNotNone(
-          gan_model.discriminator_input_data_domain_predication)
-      self.assertIsNotNone(
-          gan_model.discriminator_generated_data_domain_predication)
-      self.assertLen(gan_model.discriminator_variables, 2)  # 1 FC layer
-      self.assertIsNotNone(gan_model.discriminator_scope)
-      self.assertIsNotNone(gan_model.discriminator_fn)
+  _MODES = (tf.estimator.ModeKeys.TRAIN, tf.estimator.ModeKeys.EVAL,
+            tf.estimator.ModeKeys.PREDICT)
+
+  @classmethod
+  def setUpClass(cls):
+    super(StarGetGANModelTest, cls).setUpClass()
+    # Build the model for every mode in a single graph. The modes share
+    # variables through `AUTO_REUSE`, so the networks are only created once.
+    cls._gan_models = {}
+    with _GRAPH.as_default(), tf.compat.v1.variable_scope(cls.__name__):
+      cls._input_data = tf.ones([6, 4, 4, 3])
+      cls._input_data_domain_label = tf.one_hot([0] * 6, 5)
+      with tf.compat.v1.variable_scope('m', reuse=tf.compat.v1.AUTO_REUSE):
+        for mode in cls._MODES:
+          cls._gan_models[mode] = get_gan_model(
+              mode,
+              dummy_generator_fn,
+              dummy_discriminator_fn,
+              cls._input_data,
+              cls._input_data_domain_label,
+              add_summaries=False)
+      cls._init_op = tf.compat.v1.variables_initializer(
+          tf.compat.v1.global_variables(scope=cls.__name__))
+
+  def test_get_gan_model(self):
+    input_data = self._input_data
+    input_data_domain_label = self._input_data_domain_label
+    for mode in self._MODES:
+      gan_model = self._gan_models[mode]
+
+      self.assertEqual(input_data, gan_model.input_data)
+      self.assertIsNotNone(gan_model.generated_data)
+      self.assertIsNotNone(gan_model.generated_data_domain_target)
+      self.assertLen(gan_model.generator_variables, 1)
+      self.assertIsNotNone(gan_model.generator_scope)
+      self.assertIsNotNone(gan_model.generator_fn)
+      if mode == tf.estimator.ModeKeys.PREDICT:
+        self.assertIsNone(gan_model.input_data_domain_label)
+        self.assertEqual(input_data_domain_label,
+                         gan_model.generated_data_domain_target)
+        self.assertIsNone(gan_model.reconstructed_data)
+        self.assertIsNone(gan_model.discriminator_input_data_source_predication)
+        self.assertIsNone(
+            gan_model.discriminator_generated_data_source_predication)
+        self.assertIsNone(gan_model.discriminator_input_data_domain_predication)
+        self.assertIsNone(
+            gan_model.discriminator_generated_data_domain_predication)
+        self.assertIsNone(gan_model.discriminator_variables)
+        self.assertIsNone(gan_model.discriminator_scope)
+        self.assertIsNone(gan_model.discriminator_fn)
+      else:
+        self.assertEqual(input_data_domain_label,
+                         gan_model.input_data_domain_label)
+        self.assertIsNotNone(gan_model.reconstructed_data.shape)
+        self.assertIsNotNone(
+            gan_model.discriminator_input_data_source_predication)
+        self.assertIsNotNone(
+            gan_model.discriminator_generated_data_source_predication)
+        self.assertIsNotNone(
+            gan_model.discriminator_input_data_domain_predication)
+        self.assertIsNotNone(
+            gan_model.discriminator_generated_data_domain_predication)
+        self.assertLen(gan_model.discriminator_variables, 2)  # 1 FC layer
+        self.assertIsNotNone(gan_model.discriminator_scope)
+        self.assertIsNotNone(gan_model.discriminator_fn)
+
+    # Fetch the generated data of every mode in a single run.
+    with tf.compat.v1.Session(
+        graph=_GRAPH, config=get_session_config()) as sess:
+      sess.run(self._init_op)
+      generated_data = sess.run(
+          {mode: self._gan_models[mode].generated_data for mode in self._MODES})
+    for mode in self._MODES:
+      self.assertAllEqual([6, 4, 4, 3], generated_data[mode].shape)
 
 
 def get_dummy_gan_model():
@@ -112,18 +174,21 @@ def get_dummy_gan_model():
     gen_var = tf.compat.v1.get_variable('dummy_var', initializer=0.0)
   with tf.compat.v1.variable_scope('discriminator') as dis_scope:
     dis_var = tf.compat.v1.get_variable('dummy_var', initializer=0.0)
+  gen_dis_var = gen_var * dis_var
   return tfgan.StarGANModel(
       input_data=tf.ones([1, 2, 2, 3]),
       input_data_domain_label=tf.ones([1, 2]),
       generated_data=tf.ones([1, 2, 2, 3]),
       generated_data_domain_target=tf.ones([1, 2]),
       reconstructed_data=tf.ones([1, 2, 2, 3]),
-      discriminator_input_data_source_predication=tf.ones([1]) * dis_var,
-      discriminator_generated_data_source_predication=tf.ones(
-          [1]) * gen_var * dis_var,
-      discriminator_input_data_domain_predication=tf.ones([1, 2]) * dis_var,
-      discriminator_generated_data_domain_predication=tf.ones([1, 2]) * gen_var
-      * dis_var,
+      discriminator_input_data_source_predication=tf.broadcast_to(
+          dis_var, [1]),
+      discriminator_generated_data_source_predication=tf.broadcast_to(
+          gen_dis_var, [1]),
+      discriminator_input_data_domain_predication=tf.broadcast_to(
+          dis_var, [1, 2]),
+      discriminator_generated_data_domain_predication=tf.broadcast_to(
+          gen_dis_var, [1, 2]),
       generator_variables=[gen_var],
       generator_scope=gen_scope,
       generator_fn=None,
@@ -133,11 +198,14 @@ def get_dummy_gan_model():
 
 
 def dummy_loss_fn(gan_model):
-  loss = tf.reduce_sum(
-      input_tensor=gan_model.discriminator_input_data_domain_predication -
+  domain_diff = (
+      gan_model.discriminator_input_data_domain_predication -
       gan_model.discriminator_generated_data_domain_predication)
-  loss += tf.reduce_sum(input_tensor=gan_model.input_data -
-                        gan_model.generated_data)
+  data_diff = gan_model.input_data - gan_model.generated_data
+  # The differences have different shapes, so they can't be summed with a
+  # single `add_n`; two reductions and one add is the smallest graph.
+  loss = (tf.reduce_sum(input_tensor=domain_diff) +
+          tf.reduce_sum(input_tensor=data_diff))
   return tfgan.GANLoss(loss, loss)
 
 
@@ -149,7 +217,7 @@ def get_metrics(gan_model):
   }
 
 
-class GetEstimatorSpecTest(tf.test.TestCase, parameterized.TestCase):
+class GetEstimatorSpecTest(tf.test.TestCase):
   """Tests that the EstimatorSpec is constructed appropriately."""
 
   @classmethod
@@ -158,46 +226,74 @@ class GetEstimatorSpecTest(tf.test.TestCase, parameterized.TestCase):
     cls._generator_optimizer = tf.compat.v1.train.GradientDescentOptimizer(1.0)
     cls._discriminator_optimizer = tf.compat.v1.train.GradientDescentOptimizer(
         1.0)
-
-  @parameterized.named_parameters(('train', tf.estimator.ModeKeys.TRAIN),
-                                  ('eval', tf.estimator.ModeKeys.EVAL),
-                                  ('predict', tf.estimator.ModeKeys.PREDICT))
-  def test_get_estimator_spec(self, mode):
-    with tf.Graph().as_default():
-      self._gan_model = get_dummy_gan_model()
-      spec = get_estimator_spec(
-          mode,
-          self._gan_model,
-          loss_fn=dummy_loss_fn,
-          get_eval_metric_ops_fn=get_metrics,
-          generator_optimizer=self._generator_optimizer,
-          discriminator_optimizer=self._discriminator_optimizer)
-
-    self.assertEqual(mode, spec.mode)
-    if mode == tf.estimator.ModeKeys.PREDICT:
-      self.assertEqual(self._gan_model.generated_data, spec.predictions)
-    elif mode == tf.estimator.ModeKeys.TRAIN:
-      self.assertShapeEqual(np.array(0), spec.loss)  # must be a scalar
-      self.assertIsNotNone(spec.train_op)
-      self.assertIsNotNone(spec.training_hooks)
-    elif mode == tf.estimator.ModeKeys.EVAL:
-      self.assertEqual(self._gan_model.generated_data, spec.predictions)
-      self.assertShapeEqual(np.array(0), spec.loss)  # must be a scalar
-      self.assertIsNotNone(spec.eval_metric_ops)
+    with _GRAPH.as_default(), tf.compat.v1.variable_scope(cls.__name__):
+      cls._gan_model = get_dummy_gan_model()
+
+  def test_get_estimator_spec_all_modes(self):
+    modes = (tf.estimator.ModeKeys.TRAIN, tf.estimator.ModeKeys.EVAL,
+             tf.estimator.ModeKeys.PREDICT)
+    specs = {}
+    with _GRAPH.as_default(), tf.compat.v1.variable_scope(
+        self.id().split('.')[-1]):
+      for mode in modes:
+        with tf.compat.v1.variable_scope('m_%s' % mode):
+          specs[mode] = get_estimator_spec(
+              mode,
+              self._gan_model,
+              loss_fn=dummy_loss_fn,
+              get_eval_metric_ops_fn=get_metrics,
+              generator_optimizer=self._generator_optimizer,
+              discriminator_optimizer=self._discriminator_optimizer)
+
+    for mode in modes:
+      spec = specs[mode]
+      self.assertEqual(mode, spec.mode)
+      if mode == tf.estimator.ModeKeys.PREDICT:
+        self.assertEqual(self._gan_model.generated_data, spec.predictions)
+      elif mode == tf.estimator.ModeKeys.TRAIN:
+        self.assertEqual(0, spec.loss.shape.ndims)  # must be a scalar
+        self.assertIsNotNone(spec.train_op)
+        self.assertIsNotNone(spec.training_hooks)
+      elif mode == tf.estimator.ModeKeys.EVAL:
+        self.assertEqual(self._gan_model.generated_data, spec.predictions)
+        self.assertEqual(0, spec.loss.shape.ndims)  # must be a scalar
+        self.assertIsNotNone(spec.eval_metric_ops)
 
 
 # TODO(joelshor): Add pandas tf.test
 class StarGANEstimatorIntegrationTest(tf.test.TestCase):
 
+  @classmethod
+  def setUpClass(cls):
+    super(StarGANEstimatorIntegrationTest, cls).setUpClass()
+    batch_size = 5
+    img_size = 4
+    channel_size = 3
+    label_size = 3
+    image_data = np.zeros([batch_size, img_size, img_size, channel_size],
+                          dtype=np.float32)
+    cls._train_input_fn = cls._get_input_fn(
+        image_data, batch_size, label_size, repeat=True)
+    cls._eval_input_fn = cls._get_input_fn(image_data, batch_size, label_size)
+    predict_dataset_fn = cls._get_input_fn(image_data, batch_size, label_size)
+
+    # `stargan_prediction_input_fn_wrapper` packs the input_fn result into the
+    # features, so prediction needs tensors rather than a dataset.
+    def predict_input_fn():
+      return tf.compat.v1.data.make_one_shot_iterator(
+          predict_dataset_fn()).get_next()
+
+    cls._predict_input_fn = (
+        tfgan.estimator.stargan_prediction_input_fn_wrapper(predict_input_fn))
+    cls._prediction_size = [batch_size, img_size, img_size, channel_size]
+
   def setUp(self):
     super(StarGANEstimatorIntegrationTest, self).setUp()
-    self._model_dir = tempfile.mkdtemp()
+    self._model_dir = self.get_temp_dir()
 
   def tearDown(self):
     super(StarGANEstimatorIntegrationTest, self).tearDown()
-    if self._model_dir:
-      tf.compat.v1.summary.FileWriterCache.clear()
-      shutil.rmtree(self._model_dir)
+    tf.compat.v1.summary.FileWriterCache.clear()
 
   def _test_complete_flow(self,
                           train_input_fn,
@@ -211,10 +307,8 @@ class StarGANEstimatorIntegrationTest(tf.test.TestCase):
       lr = tf.compat.v1.train.exponential_decay(1.0, gstep, 10, 0.9)
       return tf.compat.v1.train.GradientDescentOptimizer(lr)
 
-    gopt = make_opt if lr_decay else tf.compat.v1.train.GradientDescentOptimizer(
-        1.0)
-    dopt = make_opt if lr_decay else tf.compat.v1.train.GradientDescentOptimizer(
-        1.0)
+    gopt = make_opt if lr_decay else _OPTIMIZER
+    dopt = make_opt if lr_decay else _OPTIMIZER
     est = tfgan.estimator.StarGANEstimator(
         generator_fn=dummy_generator_fn,
         discriminator_fn=dummy_discriminator_fn,
@@ -222,81 +316,73 @@ class StarGANEstimatorIntegrationTest(tf.test.TestCase):
         generator_optimizer=gopt,
         discriminator_optimizer=dopt,
         get_eval_metric_ops_fn=get_metrics,
-        model_dir=self._model_dir)
+        model_dir=self._model_dir,
+        # Checkpoints are kept: `evaluate` and `predict` restore from them.
+        config=tf.estimator.RunConfig(
+            save_summary_steps=0,
+            log_step_count_steps=None,
+            session_config=get_session_config()))
 
     # TRAIN
-    num_steps = 10
+    num_steps = 2
     est.train(train_input_fn, steps=num_steps)
 
     # EVALUTE
     scores = est.evaluate(eval_input_fn)
     self.assertEqual(num_steps, scores[tf.compat.v1.GraphKeys.GLOBAL_STEP])
-    self.assertIn('loss', six.iterkeys(scores))
+    self.assertIn('loss', scores)
     self.assertEqual(scores['discriminator_loss'] + scores['generator_loss'],
                      scores['loss'])
-    self.assertIn('mse_custom_metric', six.iterkeys(scores))
+    self.assertIn('mse_custom_metric', scores)
 
     # PREDICT
-    predictions = np.array([x for x in est.predict(predict_input_fn)])
-
+    predictions = np.empty(prediction_size, dtype=np.float32)
+    num_predictions = 0
+    for i, prediction in enumerate(est.predict(predict_input_fn)):
+      self.assertAllEqual(prediction_size[1:], prediction.shape)
+      predictions[i] = prediction
+      num_predictions += 1
+
+    self.assertEqual(prediction_size[0], num_predictions)
     self.assertAllEqual(prediction_size, predictions.shape)
 
   @staticmethod
-  def _numpy_input_fn_wrapper(numpy_input_fn, batch_size, label_size):
-    """Wrapper to remove the dictionary in numpy_input_fn.
+  def _get_input_fn(image_data, batch_size, label_size, repeat=False):
+    """Creates an input_fn that pairs batches of `image_data` with a label.
 
     NOTE:
       We create the domain_label here because the model expect a fully define
       batch_size from the input.
 
     Args:
-      numpy_input_fn: input_fn created from numpy_io
+      image_data: numpy array of images, batched along the first dimension.
       batch_size: (int) number of items for each batch
       label_size: (int) number of domains
+      repeat: (bool) whether to repeat the data indefinitely.
 
     Returns:
-      a new input_fn
+      an input_fn returning a `tf.data.Dataset` of (images, domain_label)
     """
 
-    def new_input_fn():
-      features = numpy_input_fn()
-      return features['x'], tf.one_hot([0] * batch_size, label_size)
+    domain_label = np.zeros([batch_size, label_size], dtype=np.float32)
+    domain_label[:, 0] = 1.0
 
-    return new_input_fn
+    def input_fn():
+      dataset = tf.data.Dataset.from_tensor_slices(image_data)
+      if repeat:
+        dataset = dataset.repeat()
+      dataset = dataset.batch(batch_size, drop_remainder=True)
+      return dataset.map(lambda x: (x, tf.constant(domain_label)))
 
-  def test_numpy_input_fn(self):
-    """Tests complete flow with numpy_input_fn."""
-    batch_size = 5
-    img_size = 8
-    channel_size = 3
-    label_size = 3
-    image_data = np.zeros([batch_size, img_size, img_size, channel_size],
-                          dtype=np.float32)
-    train_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-        x={'x': image_data},
-        batch_size=batch_size,
-        num_epochs=None,
-        shuffle=True)
-    eval_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-        x={'x': image_data}, batch_size=batch_size, shuffle=False)
-    predict_input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(
-        x={'x': image_data}, shuffle=False)
-
-    train_input_fn = self._numpy_input_fn_wrapper(train_input_fn, batch_size,
-                                                  label_size)
-    eval_input_fn = self._numpy_input_fn_wrapper(eval_input_fn, batch_size,
-                                                 label_size)
-    predict_input_fn = self._numpy_input_fn_wrapper(predict_input_fn,
-                                                    batch_size, label_size)
-
-    predict_input_fn = tfgan.estimator.stargan_prediction_input_fn_wrapper(
-        predict_input_fn)
+    return input_fn
 
+  def test_numpy_input_fn(self):
+    """Tests complete flow with numpy data fed through `tf.data`."""
     self._test_complete_flow(
-        train_input_fn=train_input_fn,
-        eval_input_fn=eval_input_fn,
-        predict_input_fn=predict_input_fn,
-        prediction_size=[batch_size, img_size, img_size, channel_size])
+        train_input_fn=self._train_input_fn,
+        eval_input_fn=self._eval_input_fn,
+        predict_input_fn=self._predict_input_fn,
+        prediction_size=self._prediction_size)
 
 
 class StarGANEstimatorParamsTest(tf.test.TestCase):
@@ -305,10 +391,6 @@ class StarGANEstimatorParamsTest(tf.test.TestCase):
     super(StarGANEstimatorParamsTest, self).setUp()
     self._model_dir = self.get_temp_dir()
 
-  def tearDown(self):
-    super(StarGANEstimatorParamsTest, self).tearDown()
-    tf.compat.v1.summary.FileWriterCache.clear()
-
   def test_params_used(self):
     def train_input_fn(params):
       self.assertIn('batch_size', params)
@@ -319,10 +401,15 @@ class StarGANEstimatorParamsTest(tf.test.TestCase):
         generator_fn=dummy_generator_fn,
         discriminator_fn=dummy_discriminator_fn,
         loss_fn=dummy_loss_fn,
-        generator_optimizer=tf.compat.v1.train.GradientDescentOptimizer(1.0),
-        discriminator_optimizer=tf.compat.v1.train.GradientDescentOptimizer(
-            1.0),
+        generator_optimizer=_OPTIMIZER,
+        discriminator_optimizer=_OPTIMIZER,
         model_dir=self._model_dir,
+        config=tf.estimator.RunConfig(
+            save_summary_steps=0,
+            save_checkpoints_steps=None,
+            save_checkpoints_secs=None,
+            log_step_count_steps=None,
+            session_config=get_session_config()),
         params={'batch_size': 4})
 
     est.train(train_input_fn, steps=1)